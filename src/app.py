@@ -1,13 +1,75 @@
 import os
+import io
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import pytesseract
 import pandas as pd
-import glob
 import re
 import json
-from typing import List, Dict
+import csv
+import logging
+from typing import List, Dict, Optional
+import httpx
 from langchain_openai import ChatOpenAI
 from settings import settings
+from batching import group_into_batches
+from caching import (
+    contact_cache, get_ocr_cache, image_cache_key, ocr_cache_salt, TESSERACT_CONFIG,
+)
+
+try:
+    # Faster drop-in for json.loads on LLM responses
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    # In-process tesseract bindings; avoids spawning a tesseract process per image
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+logger = logging.getLogger(__name__)
+
+# Supported image formats
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.tiff', '.bmp'}
+
+# Columns written to the contacts CSV
+CONTACT_FIELDS = ['name', 'designation', 'company']
+
+# Identifies this process's OCR pipeline in the shared OCR cache
+OCR_CACHE_SALT = ocr_cache_salt('tesserocr' if tesserocr is not None else 'pytesseract')
+
+# Pulls the JSON object out of a fenced LLM response, whatever the language tag
+_FENCE_RE = re.compile(r'```[\w-]*\s*(\{.*?\})\s*```', re.S)
+
+# Prompts for contact extraction; only the OCR text changes between calls
+SYSTEM_PROMPT = """You are a helpful assistant that extracts contact information from text.
+Your task is to identify and structure information about people, including their names, job titles, and companies.
+Return the information in valid JSON format with a 'contacts' array. Do not wrap the JSON in markdown code blocks."""
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+USER_PROMPT_TEMPLATE = """Extract contact information from the following text. For each person, provide their name, job title/designation, and company name in a structured format.
+Only include real contacts - ignore UI elements, timestamps, and navigation items.
+
+Text to process:
+{text}
+
+Format the output exactly like this, with no markdown formatting:
+{{
+    "contacts": [
+        {{"name": "Person Name", "designation": "Job Title", "company": "Company Name"}},
+        ...
+    ]
+}}"""
+_format_user_prompt = USER_PROMPT_TEMPLATE.format
+
+# Patterns used by clean_text, compiled once per process
+_SPECIAL_RE = re.compile(r'[^\w\s\-&,.():]')
+_WS_INLINE_RE = re.compile(r'[^\S\n]+')
+# ASCII bytes matched by _SPECIAL_RE, for the bytes.translate fast path
+_ASCII_DELETE = bytes(c for c in range(128) if _SPECIAL_RE.match(chr(c)))
 
 def preprocess_image(image):
     """Preprocess image to improve OCR accuracy"""
@@ -15,19 +77,59 @@ def preprocess_image(image):
 
 def clean_text(text: str) -> str:
     """Clean extracted text while preserving structure"""
+    # Remove special characters but keep basic punctuation
+    if text.isascii():
+        # Same result as _SPECIAL_RE in a single C-level scan over the bytes
+        text = text.encode('ascii').translate(None, _ASCII_DELETE).decode('ascii')
+    else:
+        text = _SPECIAL_RE.sub('', text)
     # Remove multiple spaces while preserving newlines
-    lines = []
-    for line in text.split('\n'):
-        line = line.strip()
-        if line and not line.isspace():
-            # Remove special characters but keep basic punctuation
-            line = re.sub(r'[^\w\s\-&,.():]', '', line)
-            line = re.sub(r'\s+', ' ', line).strip()
-            if line:
-                lines.append(line)
-    return '\n'.join(lines)
-
-def get_llm():
+    text = _WS_INLINE_RE.sub(' ', text)
+    return '\n'.join(filter(None, (line.strip() for line in text.split('\n'))))
+
+# Per-process tesserocr API, created by _init_ocr_worker in each pool worker
+_tess_api = None
+
+def _init_ocr_worker():
+    """Load tesseract once per worker process when tesserocr is installed"""
+    global _tess_api
+    if tesserocr is not None:
+        _tess_api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_BLOCK, oem=tesserocr.OEM.DEFAULT)
+        _tess_api.SetVariable('preserve_interword_spaces', '1')
+
+def image_to_text(image) -> str:
+    """Run tesseract on a PIL image, in-process when tesserocr is available"""
+    if _tess_api is not None:
+        _tess_api.SetImage(image)
+        return _tess_api.GetUTF8Text()
+    return pytesseract.image_to_string(image, config=TESSERACT_CONFIG)
+
+def _ocr_one(image_path: str) -> str:
+    """OCR a single image file and return its cleaned text (runs in a worker process)"""
+    with open(image_path, 'rb') as f:
+        img_bytes = f.read()
+    
+    # Reuse the text from a previous run on the same image
+    ocr_cache = get_ocr_cache()
+    key = image_cache_key(img_bytes, OCR_CACHE_SALT)
+    cleaned_text = ocr_cache.get(key)
+    if cleaned_text is not None:
+        return cleaned_text
+    
+    with Image.open(io.BytesIO(img_bytes)) as image:
+        text = image_to_text(preprocess_image(image))
+    cleaned_text = clean_text(text)
+    ocr_cache[key] = cleaned_text
+    return cleaned_text
+
+def _safe_ocr_one(image_path: str):
+    """Wrap _ocr_one so one bad image doesn't abort the whole pool map"""
+    try:
+        return _ocr_one(image_path), None
+    except Exception as e:
+        return None, str(e)
+
+def build_llm(**client_options):
     """Configure and return the LLM"""
     if settings.LLM_PROVIDER == "llama":
         llm = ChatOpenAI(
@@ -36,6 +138,7 @@ def get_llm():
             model=settings.LLM.LLAMA.MODEL,
             max_tokens=settings.LLM.LLAMA.MAX_TOKENS,
             temperature=settings.LLM.LLAMA.TEMPERATURE,
+            **client_options,
         )     
         # Configure the model to use the system message and JSON response format
         return llm.bind(
@@ -43,160 +146,169 @@ def get_llm():
         )
     raise ValueError(f"Unsupported LLM provider: {settings.LLM_PROVIDER}")
 
-def extract_contacts_with_llm(text: str) -> List[Dict]:
-    """Use LLM to extract structured contact information"""
-    system_prompt = """You are a helpful assistant that extracts contact information from text.
-Your task is to identify and structure information about people, including their names, job titles, and companies.
-Return the information in valid JSON format with a 'contacts' array. Do not wrap the JSON in markdown code blocks."""
-
-    user_prompt = f"""Extract contact information from the following text. For each person, provide their name, job title/designation, and company name in a structured format.
-Only include real contacts - ignore UI elements, timestamps, and navigation items.
-
-Text to process:
-{text}
-
-Format the output exactly like this, with no markdown formatting:
-{{
-    "contacts": [
-        {{"name": "Person Name", "designation": "Job Title", "company": "Company Name"}},
-        ...
-    ]
-}}"""
-
+async def aextract_contacts_with_llm(text: str, llm) -> List[Dict]:
+    """Use LLM to extract structured contact information
+    
+    llm must be bound to an async HTTP client owned by the running event loop.
+    """
     try:
-        llm = get_llm()
+        # Skip the LLM entirely when this text (or a near-duplicate) was seen before
+        cached = await contact_cache.aget(text)
+        if cached is not None:
+            return cached
+
         messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
+            _SYSTEM_MESSAGE,
+            {"role": "user", "content": _format_user_prompt(text=text)}
         ]
-        response = llm.invoke(messages)
+        response = await llm.ainvoke(messages)
         
         # Get the content from the response
         response_content = response.content
         
         # If the response is wrapped in markdown code blocks, extract the JSON
-        if response_content.startswith('```') and response_content.endswith('```'):
-            # Extract content between the first and last ```
-            response_content = response_content.split('```')[1]
-            # Remove any language identifier if present (e.g. ```json)
-            if '\n' in response_content:
-                response_content = response_content.split('\n', 1)[1]
+        match = _FENCE_RE.search(response_content)
+        if match:
+            response_content = match.group(1)
         
         # Parse the JSON
-        data = json.loads(response_content)
-        return data.get('contacts', [])
+        data = json_loads(response_content)
+        # Drop malformed entries (e.g. bare strings) that can't be written as rows
+        contacts = [contact for contact in data.get('contacts', []) if isinstance(contact, dict)]
+        contact_cache.put(text, contacts)
+        return contacts
         
     except Exception as e:
-        print(f"Error extracting contacts with LLM: {str(e)}")
-        print("Response:", response if 'response' in locals() else 'No response')
+        logger.error("Error extracting contacts with LLM: %s", e)
+        logger.debug("Response: %s", response if 'response' in locals() else 'No response')
         return []
 
-def save_contacts_to_csv(contacts: List[Dict], csv_path: str, is_new_file: bool = False) -> None:
-    """Save contacts to CSV file, either creating a new file or appending to existing"""
-    df = pd.DataFrame(contacts)
-    if is_new_file:
-        df.to_csv(csv_path, index=False, mode='w')
-    else:
-        df.to_csv(csv_path, index=False, mode='a', header=False)
-    print(f"Saved {len(contacts)} contacts to {csv_path}")
+async def extract_contacts_from_batches(batches: List[str], on_batch_done) -> List[List[Dict]]:
+    """Run the LLM over all batches concurrently, returning results in batch order
+    
+    on_batch_done(batch_idx, contacts) is called as each batch finishes.
+    """
+    semaphore = asyncio.Semaphore(settings.LLM.LLAMA.MAX_CONCURRENT_REQUESTS)
+    results = [[] for _ in batches]
+
+    # One LLM client per run, so every batch shares its keep-alive connections.
+    # Pooled connections are tied to the event loop that opened them, so the
+    # async client is closed here rather than outliving asyncio.run()
+    limits = httpx.Limits(max_connections=settings.LLM.LLAMA.MAX_CONCURRENT_REQUESTS)
+    async with httpx.AsyncClient(limits=limits) as http_client:
+        llm = build_llm(http_async_client=http_client)
+
+        async def extract(batch_idx: int, text: str) -> tuple[int, List[Dict]]:
+            async with semaphore:
+                return batch_idx, await aextract_contacts_with_llm(text, llm)
 
-def process_images(images_folder: str, csv_path: str, batch_size: int = 10) -> List[Dict]:
+        tasks = [extract(batch_idx, text) for batch_idx, text in enumerate(batches)]
+        for future in asyncio.as_completed(tasks):
+            batch_idx, batch_contacts = await future
+            results[batch_idx] = batch_contacts
+            on_batch_done(batch_idx, batch_contacts)
+    return results
+
+def process_images(images_folder: str, csv_path: str, batch_size: Optional[int] = None) -> List[Dict]:
     """Process images in batches and extract text
     
     Args:
         images_folder: Directory containing the images
         csv_path: Path to save the CSV file
-        batch_size: Number of images to process in each batch (default: 10)
+        batch_size: Optional cap on images per LLM batch; by default batches
+            are filled up to the prompt token budget
     """
     all_contacts = []
-    current_batch_text = []
-    current_batch_count = 0
-    is_first_batch = True
-    
-    # Supported image formats
-    image_patterns = ['*.jpg', '*.jpeg', '*.png', '*.tiff', '*.bmp']
-    image_files = []
+    cleaned_texts = []
     
-    # Get all image files
-    for pattern in image_patterns:
-        image_files.extend(glob.glob(os.path.join(images_folder, pattern)))
+    # Get all image files in a single directory scan, skipping hidden files
+    # such as macOS "._" resource forks as glob did
+    image_files = sorted(
+        entry.path for entry in os.scandir(images_folder)
+        if entry.is_file() and not entry.name.startswith('.')
+        and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+    )
     
     total_images = len(image_files)
-    print(f"Found {total_images} images in total")
+    logger.info("Found %d images in total", total_images)
     
-    # Process each image
-    for idx, image_path in enumerate(image_files, 1):
-        try:
-            print(f"\nProcessing image {idx}/{total_images}: {os.path.basename(image_path)}...")
-            image = Image.open(image_path)
-            
-            # Preprocess image
-            image = preprocess_image(image)
-            
-            # Configure tesseract for better accuracy with screenshots
-            custom_config = r'--oem 3 --psm 6 -c preserve_interword_spaces=1'
-            text = pytesseract.image_to_string(image, config=custom_config)
-            
-            # Clean the text
-            cleaned_text = clean_text(text)
-            print("\nExtracted text:")
-            print(cleaned_text)
-            
-            # Add to current batch
-            current_batch_text.append(cleaned_text)
-            current_batch_count += 1
+    # OCR all images in parallel worker processes, logging each result in
+    # order as soon as it arrives
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_ocr_worker) as executor:
+        ocr_results = executor.map(_safe_ocr_one, image_files, chunksize=4)
+        for idx, (image_path, (cleaned_text, error)) in enumerate(zip(image_files, ocr_results), 1):
+            logger.info("Processed image %d/%d: %s", idx, total_images, os.path.basename(image_path))
+            if error is not None:
+                logger.error("Error processing %s: %s", image_path, error)
+                continue
+            logger.debug("Extracted text:\n%s", cleaned_text)
+            cleaned_texts.append(cleaned_text)
+    
+    # Pack the cleaned text into batches that fill the prompt token budget
+    batches = group_into_batches(cleaned_texts, settings.LLM.LLAMA.MAX_INPUT_TOKENS, batch_size)
+    
+    # Stream every batch into a single open CSV file as soon as it completes
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CONTACT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        f.flush()
+        
+        completed_contacts = 0
+        
+        def on_batch_done(batch_idx: int, batch_contacts: List[Dict]):
+            nonlocal completed_contacts
             
-            # Process batch if we've reached batch_size or this is the last image
-            if current_batch_count == batch_size or idx == total_images:
-                print(f"\nProcessing batch of {current_batch_count} images with LLM...")
-                combined_text = "\n\n".join(current_batch_text)
-                batch_contacts = extract_contacts_with_llm(combined_text)
-                all_contacts.extend(batch_contacts)
-                
-                # Save batch contacts to CSV
-                save_contacts_to_csv(batch_contacts, csv_path, is_first_batch)
-                is_first_batch = False
-                
-                # Print progress
-                print(f"Extracted {len(batch_contacts)} contacts from this batch.")
-                print(f"Total contacts so far: {len(all_contacts)}")
-                
-                # Reset batch
-                current_batch_text = []
-                current_batch_count = 0
+            # Save batch contacts to CSV
+            writer.writerows(batch_contacts)
+            f.flush()
+            completed_contacts += len(batch_contacts)
             
-        except Exception as e:
-            print(f"Error processing {image_path}: {str(e)}")
+            # Print progress
+            logger.info("Extracted %d contacts from batch %d.", len(batch_contacts), batch_idx + 1)
+            logger.info("Total contacts so far: %d", completed_contacts)
+        
+        # Send all batches to the LLM concurrently
+        logger.info("Processing %d batches with LLM...", len(batches))
+        batch_results = asyncio.run(extract_contacts_from_batches(batches, on_batch_done))
     
+    for batch_contacts in batch_results:
+        all_contacts.extend(batch_contacts)
+    
+    logger.info("Saved %d contacts to %s", len(all_contacts), csv_path)
     return all_contacts
 
 def main():
+    # Only this module logs progress; libraries such as httpx stay at the
+    # root's WARNING level. Set LOG_LEVEL=DEBUG to also dump the OCR text
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+    
     # Folder containing images (relative to script location)
     images_folder = "images2"
     csv_path = 'extracted_contacts2.csv'
-    batch_size = 10  # Process 10 images at a time
+    batch_size = None  # Fill each LLM batch up to the token budget
     
     # Create images folder if it doesn't exist
     if not os.path.exists(images_folder):
         os.makedirs(images_folder)
-        print(f"Created {images_folder} directory. Please place your images there.")
+        logger.info("Created %s directory. Please place your images there.", images_folder)
         return
     
     # Process all images in batches and save to CSV
     contacts = process_images(images_folder, csv_path, batch_size)
     
     if contacts:
-        print(f"\nExtracted {len(contacts)} total contacts from all images")
-        print(f"All results have been saved to {csv_path}")
+        logger.info("Extracted %d total contacts from all images", len(contacts))
+        logger.info("All results have been saved to %s", csv_path)
         
         # Print preview of all extracted contacts
-        print("\nAll extracted contacts:")
+        logger.info("All extracted contacts:")
         df = pd.read_csv(csv_path)
         pd.set_option('display.max_columns', None)
         pd.set_option('display.max_rows', None)
         print(df)
     else:
-        print("\nNo contacts were extracted from the images")
+        logger.info("No contacts were extracted from the images")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,32 @@
+from typing import List, Optional
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the prompt tokens for text (about four characters per token)"""
+    return len(text) // 4 + 1
+
+
+def group_into_batches(texts: List[str], token_budget: int, batch_size: Optional[int] = None) -> List[str]:
+    """Pack cleaned texts into as few LLM prompts as fit the token budget
+
+    A batch is closed when adding the next text would exceed token_budget or,
+    if batch_size is given, when it already holds batch_size texts. A single
+    text larger than the budget still gets a batch of its own.
+    """
+    batches = []
+    current_batch_text = []
+    current_batch_tokens = 0
+
+    for text in texts:
+        text_tokens = estimate_tokens(text)
+        if current_batch_text and (current_batch_tokens + text_tokens > token_budget
+                                   or len(current_batch_text) == batch_size):
+            batches.append("\n\n".join(current_batch_text))
+            current_batch_text = []
+            current_batch_tokens = 0
+        current_batch_text.append(text)
+        current_batch_tokens += text_tokens
+
+    if current_batch_text:
+        batches.append("\n\n".join(current_batch_text))
+    return batches
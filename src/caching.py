@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional
+
+import diskcache
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Embedding model used for the semantic layer of the contact cache. The
+# semantic layer is only enabled when sentence-transformers is installed.
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SIMILARITY_THRESHOLD = 0.99
+
+# Cleaned OCR text keyed by image content, kept across runs and processes
+OCR_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'contact_ocr_cache')
+
+# Tesseract settings tuned for screenshots
+TESSERACT_CONFIG = r'--oem 3 --psm 6 -c preserve_interword_spaces=1'
+
+# Bump whenever preprocess_image or clean_text changes their output. Both
+# entry points share the OCR cache, so both must read this one value
+OCR_PIPELINE_VERSION = 1
+
+
+class ContactCache:
+    """Cache LLM-extracted contacts by OCR text
+
+    Lookups first try an exact match on a blake2b hash of the text, then fall
+    back to cosine similarity between sentence embeddings so near-duplicate
+    screenshots also skip the LLM call. Only texts that fit the embedding
+    model's window take part in the semantic layer; longer batch prompts
+    would be truncated and compare equal on their first page alone.
+    Embeddings are stored quantized to int8, a quarter of the float32
+    footprint.
+    """
+
+    def __init__(self, maxsize: int = 512, threshold: float = SIMILARITY_THRESHOLD):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self._exact = OrderedDict()
+        self._keys = []
+        self._vectors = None
+        self._norms = None
+        self._pending = {}
+        self._embedder = None
+        self._embedder_loaded = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.blake2b(text.encode()).hexdigest()
+
+    def _get_embedder(self):
+        """Load the sentence embedder once; None if it is missing or fails to load
+
+        A failed load (e.g. the model download) turns the semantic layer off
+        for the process instead of being retried on every lookup.
+        """
+        if not self._embedder_loaded:
+            with self._load_lock:
+                if not self._embedder_loaded:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError:
+                        self._embedder = None
+                    else:
+                        try:
+                            self._embedder = SentenceTransformer(EMBEDDING_MODEL)
+                        except Exception as e:
+                            logger.warning("Semantic contact cache disabled, could not load %s: %s",
+                                           EMBEDDING_MODEL, e)
+                            self._embedder = None
+                    self._embedder_loaded = True
+        return self._embedder
+
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        """Return the normalized embedding of text, or None if it can't be embedded faithfully"""
+        embedder = self._get_embedder()
+        if embedder is None:
+            return None
+        # Leave room for the [CLS]/[SEP] tokens the model adds
+        if len(embedder.tokenizer.tokenize(text)) > embedder.max_seq_length - 2:
+            return None
+        return embedder.encode(text, normalize_embeddings=True).astype(np.float32)
+
+    @staticmethod
+    def _quantize(vector: np.ndarray) -> np.ndarray:
+        """Scale a unit vector into int8 (components lie in [-1, 1])"""
+        return np.round(vector * 127).astype(np.int8)
+
+    def _get_exact(self, key: str) -> Optional[List[Dict]]:
+        with self._lock:
+            if key in self._exact:
+                self._exact.move_to_end(key)
+                return list(self._exact[key])
+        return None
+
+    def get(self, text: str) -> Optional[List[Dict]]:
+        """Return cached contacts for text, or None on a miss"""
+        key = self._key(text)
+        cached = self._get_exact(key)
+        if cached is not None:
+            return cached
+
+        # Embed outside the lock so concurrent lookups don't queue behind the model
+        vector = self._embed(text)
+        if vector is None:
+            return None
+        vector = self._quantize(vector)
+        with self._lock:
+            if self._vectors is not None:
+                # Integer dot products, rescaled by the norms of the quantized vectors
+                query = vector.astype(np.int32)
+                query_norm = np.sqrt(float(query @ query))
+                scores = (self._vectors @ query) / (self._norms * query_norm)
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    return list(self._exact[self._keys[best]])
+            # Remember the embedding for put(); drop stale ones left by failed calls
+            if len(self._pending) >= self.maxsize:
+                self._pending.clear()
+            self._pending[key] = vector
+        return None
+
+    async def aget(self, text: str) -> Optional[List[Dict]]:
+        """Async get() that loads and runs the embedding model off the event loop"""
+        cached = self._get_exact(self._key(text))
+        if cached is not None:
+            return cached
+        return await asyncio.to_thread(self.get, text)
+
+    def put(self, text: str, contacts: List[Dict]) -> None:
+        """Store the contacts extracted from text"""
+        key = self._key(text)
+        with self._lock:
+            vector = self._pending.pop(key, None)
+            if key in self._exact:
+                self._exact[key] = list(contacts)
+                self._exact.move_to_end(key)
+                return
+            self._exact[key] = list(contacts)
+
+            if vector is not None:
+                self._keys.append(key)
+                norm = np.sqrt(float(vector.astype(np.int32) @ vector.astype(np.int32)))
+                if self._vectors is None:
+                    self._vectors = vector[np.newaxis, :]
+                    self._norms = np.array([norm], dtype=np.float32)
+                else:
+                    self._vectors = np.vstack([self._vectors, vector])
+                    self._norms = np.append(self._norms, np.float32(norm))
+
+            # Evict the least recently used entry once over capacity
+            if len(self._exact) > self.maxsize:
+                evicted, _ = self._exact.popitem(last=False)
+                if evicted in self._keys:
+                    idx = self._keys.index(evicted)
+                    del self._keys[idx]
+                    self._vectors = np.delete(self._vectors, idx, axis=0)
+                    self._norms = np.delete(self._norms, idx)
+                    if not self._keys:
+                        self._vectors = None
+                        self._norms = None
+
+
+# Shared by every caller in the process so repeated runs hit the same cache
+contact_cache = ContactCache()
+
+
+_ocr_cache = None
+_ocr_cache_pid = None
+
+
+def get_ocr_cache() -> diskcache.Cache:
+    """Return this process's handle to the on-disk OCR cache
+
+    diskcache handles must not be shared across fork, so each pool worker
+    opens its own.
+    """
+    global _ocr_cache, _ocr_cache_pid
+    if _ocr_cache is None or _ocr_cache_pid != os.getpid():
+        _ocr_cache = diskcache.Cache(OCR_CACHE_DIR)
+        _ocr_cache_pid = os.getpid()
+    return _ocr_cache
+
+
+def ocr_cache_salt(engine: str) -> str:
+    """Describe the OCR pipeline for image_cache_key
+
+    Mixed into cache keys so a different engine, tesseract config or cleaner
+    never serves text cached by an older pipeline.
+    """
+    return '|'.join([engine, TESSERACT_CONFIG, f'pipeline-v{OCR_PIPELINE_VERSION}'])
+
+
+def image_cache_key(img_bytes: bytes, salt: str) -> str:
+    """Content hash identifying an image in the OCR cache
+
+    salt describes the OCR pipeline (engine, config, cleaner version), so
+    text produced by a different pipeline is never returned for the image.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(salt.encode())
+    digest.update(b'\0')
+    digest.update(img_bytes)
+    return digest.hexdigest()
@@ -6,6 +6,8 @@ class LlamaConfig:
     MODEL = "meta-llama/llama-4-maverick:free"
     MAX_TOKENS = 4096
     TEMPERATURE = 0.2
+    MAX_CONCURRENT_REQUESTS = 5
+    MAX_INPUT_TOKENS = 3000
     
     @classmethod
     def get_chat(cls):
@@ -1,17 +1,72 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import tempfile
 import os
 from PIL import Image
 import pytesseract
 import json
 import re
-from typing import List, Dict
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Optional
+import httpx
 from langchain_openai import ChatOpenAI
 from src.settings import settings
+from src.batching import group_into_batches
+from src.caching import (
+    contact_cache, get_ocr_cache, image_cache_key, ocr_cache_salt, TESSERACT_CONFIG,
+)
 import zipfile
 import io
 from datetime import datetime
+import xlsxwriter
+import threading
+
+try:
+    # Faster drop-in for json.loads on LLM responses
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    # In-process tesseract bindings; avoids spawning a tesseract process per image
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# Identifies this process's OCR pipeline in the shared OCR cache
+OCR_CACHE_SALT = ocr_cache_salt('tesserocr' if tesserocr is not None else 'pytesseract')
+
+# Pulls the JSON object out of a fenced LLM response, whatever the language tag
+_FENCE_RE = re.compile(r'```[\w-]*\s*(\{.*?\})\s*```', re.S)
+
+# Prompts for contact extraction; only the OCR text changes between calls
+SYSTEM_PROMPT = """You are a helpful assistant that extracts contact information from text.
+Your task is to identify and structure information about people, including their names, job titles, and companies.
+Return the information in valid JSON format with a 'contacts' array. Do not wrap the JSON in markdown code blocks."""
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+USER_PROMPT_TEMPLATE = """Extract contact information from the following text. For each person, provide their name, job title/designation, and company name in a structured format.
+Only include real contacts - ignore UI elements, timestamps, and navigation items.
+
+Text to process:
+{text}
+
+Format the output exactly like this, with no markdown formatting:
+{{
+    "contacts": [
+        {{"name": "Person Name", "designation": "Job Title", "company": "Company Name"}},
+        ...
+    ]
+}}"""
+_format_user_prompt = USER_PROMPT_TEMPLATE.format
+
+# Patterns used by clean_text, compiled once per process
+_SPECIAL_RE = re.compile(r'[^\w\s\-&,.():]')
+_WS_INLINE_RE = re.compile(r'[^\S\n]+')
+# ASCII bytes matched by _SPECIAL_RE, for the bytes.translate fast path
+_ASCII_DELETE = bytes(c for c in range(128) if _SPECIAL_RE.match(chr(c)))
 
 # Page configuration
 st.set_page_config(
@@ -33,54 +88,48 @@ def create_excel_file(df: pd.DataFrame, filename: str) -> bytes:
     """Create Excel file from DataFrame and return bytes"""
     output = io.BytesIO()
     
-    # Create Excel writer object
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        # Write DataFrame to Excel
-        df.to_excel(writer, sheet_name='Contacts', index=False)
-        
-        # Get workbook and worksheet
-        workbook = writer.book
-        worksheet = writer.sheets['Contacts']
-        
-        # Auto-adjust column widths
-        for column in worksheet.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)  # Cap at 50 characters
-            worksheet.column_dimensions[column_letter].width = adjusted_width
-        
-        # Add some formatting
-        from openpyxl.styles import Font, PatternFill, Alignment
-        
-        # Header formatting
-        header_font = Font(bold=True, color="FFFFFF")
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_alignment = Alignment(horizontal="center", vertical="center")
-        
-        for cell in worksheet[1]:  # First row (headers)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = header_alignment
-        
-        # Add metadata sheet
-        metadata_df = pd.DataFrame({
-            'Property': ['Generated Date', 'Total Contacts', 'Application', 'File Format'],
-            'Value': [
-                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                len(df),
-                'Bilvantis Contact Extraction',
-                'Excel (.xlsx)'
-            ]
-        })
-        metadata_df.to_excel(writer, sheet_name='Metadata', index=False)
+    # constant_memory flushes each row to disk as soon as the next one starts,
+    # so rows must be written in order and column widths set up front
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Contacts')
+    
+    headers = [str(column) for column in df.columns]
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    
+    # Auto-adjust column widths
+    header_lengths = np.array([len(header) for header in headers])
+    cell_lengths = np.char.str_len(df.fillna('').astype(str).to_numpy().astype('U'))
+    max_lengths = np.maximum(cell_lengths.max(axis=0, initial=0), header_lengths)
+    adjusted_widths = np.minimum(max_lengths + 2, 50)  # Cap at 50 characters
+    for i, adjusted_width in enumerate(adjusted_widths):
+        worksheet.set_column(i, i, int(adjusted_width))
     
-    output.seek(0)
+    # Header formatting
+    header_format = workbook.add_format({
+        'bold': True,
+        'font_color': 'white',
+        'bg_color': '#366092',
+        'align': 'center',
+        'valign': 'vcenter',
+    })
+    worksheet.write_row(0, 0, headers, header_format)
+    
+    for row_idx, row in enumerate(rows, 1):
+        worksheet.write_row(row_idx, 0, row)
+    
+    # Add metadata sheet
+    metadata_sheet = workbook.add_worksheet('Metadata')
+    metadata_rows = [
+        ['Property', 'Value'],
+        ['Generated Date', datetime.now().strftime('%Y-%m-%d %H:%M:%S')],
+        ['Total Contacts', len(df)],
+        ['Application', 'Bilvantis Contact Extraction'],
+        ['File Format', 'Excel (.xlsx)'],
+    ]
+    for row_idx, row in enumerate(metadata_rows):
+        metadata_sheet.write_row(row_idx, 0, row)
+    
+    workbook.close()
     return output.getvalue()
 
 def login_page():
@@ -123,19 +172,57 @@ def preprocess_image(image):
 
 def clean_text(text: str) -> str:
     """Clean extracted text while preserving structure"""
+    # Remove special characters but keep basic punctuation
+    if text.isascii():
+        # Same result as _SPECIAL_RE in a single C-level scan over the bytes
+        text = text.encode('ascii').translate(None, _ASCII_DELETE).decode('ascii')
+    else:
+        text = _SPECIAL_RE.sub('', text)
     # Remove multiple spaces while preserving newlines
-    lines = []
-    for line in text.split('\n'):
-        line = line.strip()
-        if line and not line.isspace():
-            # Remove special characters but keep basic punctuation
-            line = re.sub(r'[^\w\s\-&,.():]', '', line)
-            line = re.sub(r'\s+', ' ', line).strip()
-            if line:
-                lines.append(line)
-    return '\n'.join(lines)
+    text = _WS_INLINE_RE.sub(' ', text)
+    return '\n'.join(filter(None, (line.strip() for line in text.split('\n'))))
 
-def get_llm():
+# Per-thread tesserocr API; the tesseract API object is not thread-safe
+_tess_local = threading.local()
+
+def image_to_text(image) -> str:
+    """Run tesseract on a PIL image, in-process when tesserocr is available"""
+    if tesserocr is not None:
+        api = getattr(_tess_local, 'api', None)
+        if api is None:
+            api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_BLOCK, oem=tesserocr.OEM.DEFAULT)
+            api.SetVariable('preserve_interword_spaces', '1')
+            _tess_local.api = api
+        api.SetImage(image)
+        return api.GetUTF8Text()
+    return pytesseract.image_to_string(image, config=TESSERACT_CONFIG)
+
+def ocr_image(image) -> str:
+    """OCR a PIL image and return its cleaned text"""
+    text = image_to_text(preprocess_image(image))
+    return clean_text(text)
+
+def load_image(uploaded_file) -> Image.Image:
+    """Open and fully decode an uploaded image"""
+    image = Image.open(uploaded_file)
+    image.load()
+    return image
+
+def ocr_image_bytes(img_bytes: bytes) -> str:
+    """OCR a single uploaded image and return its cleaned text"""
+    # Reuse the text from a previous run on the same image
+    ocr_cache = get_ocr_cache()
+    key = image_cache_key(img_bytes, OCR_CACHE_SALT)
+    cleaned_text = ocr_cache.get(key)
+    if cleaned_text is not None:
+        return cleaned_text
+    
+    with Image.open(io.BytesIO(img_bytes)) as image:
+        cleaned_text = ocr_image(image)
+    ocr_cache[key] = cleaned_text
+    return cleaned_text
+
+def build_llm(**client_options):
     """Configure and return the LLM"""
     if settings.LLM_PROVIDER == "llama":
         llm = ChatOpenAI(
@@ -144,6 +231,7 @@ def get_llm():
             model=settings.LLM.LLAMA.MODEL,
             max_tokens=settings.LLM.LLAMA.MAX_TOKENS,
             temperature=settings.LLM.LLAMA.TEMPERATURE,
+            **client_options,
         )     
         # Configure the model to use the system message and JSON response format
         return llm.bind(
@@ -151,123 +239,155 @@ def get_llm():
         )
     raise ValueError(f"Unsupported LLM provider: {settings.LLM_PROVIDER}")
 
-def extract_contacts_with_llm(text: str) -> List[Dict]:
-    """Use LLM to extract structured contact information"""
-    system_prompt = """You are a helpful assistant that extracts contact information from text.
-Your task is to identify and structure information about people, including their names, job titles, and companies.
-Return the information in valid JSON format with a 'contacts' array. Do not wrap the JSON in markdown code blocks."""
+@st.cache_resource(show_spinner=False)
+def get_llm():
+    """Return the LLM for synchronous calls, shared across reruns so its connections are reused"""
+    return build_llm()
 
-    user_prompt = f"""Extract contact information from the following text. For each person, provide their name, job title/designation, and company name in a structured format.
-Only include real contacts - ignore UI elements, timestamps, and navigation items.
+def build_messages(text: str) -> List[Dict]:
+    """Build the chat messages asking the LLM to extract contacts from text"""
+    return [
+        _SYSTEM_MESSAGE,
+        {"role": "user", "content": _format_user_prompt(text=text)}
+    ]
 
-Text to process:
-{text}
+def parse_contacts(response_content: str) -> List[Dict]:
+    """Parse the contacts array out of the LLM response"""
+    # If the response is wrapped in markdown code blocks, extract the JSON
+    match = _FENCE_RE.search(response_content)
+    if match:
+        response_content = match.group(1)
+    
+    # Parse the JSON
+    data = json_loads(response_content)
+    return data.get('contacts', [])
 
-Format the output exactly like this, with no markdown formatting:
-{{
-    "contacts": [
-        {{"name": "Person Name", "designation": "Job Title", "company": "Company Name"}},
-        ...
-    ]
-}}"""
+def extract_contacts_with_llm(text: str) -> List[Dict]:
+    """Use LLM to extract structured contact information
+    
+    Errors are raised to the caller so failed calls are never cached.
+    """
+    # Skip the LLM entirely when this text (or a near-duplicate) was seen before
+    cached = contact_cache.get(text)
+    if cached is not None:
+        return cached
+
+    llm = get_llm()
+    response = llm.invoke(build_messages(text))
+    contacts = parse_contacts(response.content)
+    contact_cache.put(text, contacts)
+    return contacts
 
+async def aextract_contacts_with_llm(text: str, llm) -> List[Dict]:
+    """Async variant of extract_contacts_with_llm for concurrent batch processing
+    
+    llm must be bound to an async HTTP client owned by the running event loop.
+    """
     try:
-        llm = get_llm()
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        response = llm.invoke(messages)
-        
-        # Get the content from the response
-        response_content = response.content
-        
-        # If the response is wrapped in markdown code blocks, extract the JSON
-        if response_content.startswith('```') and response_content.endswith('```'):
-            # Extract content between the first and last ```
-            response_content = response_content.split('```')[1]
-            # Remove any language identifier if present (e.g. ```json)
-            if '\n' in response_content:
-                response_content = response_content.split('\n', 1)[1]
-        
-        # Parse the JSON
-        data = json.loads(response_content)
-        return data.get('contacts', [])
+        # Skip the LLM entirely when this text (or a near-duplicate) was seen before
+        cached = await contact_cache.aget(text)
+        if cached is not None:
+            return cached
+
+        response = await llm.ainvoke(build_messages(text))
+        # Drop malformed entries (e.g. bare strings) that can't be written as rows
+        contacts = [contact for contact in parse_contacts(response.content) if isinstance(contact, dict)]
+        contact_cache.put(text, contacts)
+        return contacts
         
     except Exception as e:
         st.error(f"Error extracting contacts with LLM: {str(e)}")
         return []
 
-def process_single_image(image) -> tuple[str, List[Dict]]:
-    """Process a single image and return extracted text and contacts"""
-    try:
-        # Preprocess image
-        image = preprocess_image(image)
-        
-        # Configure tesseract for better accuracy with screenshots
-        custom_config = r'--oem 3 --psm 6 -c preserve_interword_spaces=1'
-        text = pytesseract.image_to_string(image, config=custom_config)
-        
-        # Clean the text
-        cleaned_text = clean_text(text)
-        
-        # Extract contacts using LLM
-        contacts = extract_contacts_with_llm(cleaned_text)
-        
-        return cleaned_text, contacts
-        
-    except Exception as e:
-        st.error(f"Error processing image: {str(e)}")
-        return "", []
+@st.cache_data(show_spinner=False)
+def process_single_image_bytes(img_bytes: bytes) -> tuple[str, List[Dict]]:
+    """Process a single image and return extracted text and contacts
+    
+    Cached on the raw file bytes, so clicking "Extract Contacts" again on the
+    same upload skips both OCR and the LLM call.
+    """
+    # OCR and clean the text
+    cleaned_text = ocr_image_bytes(img_bytes)
+    
+    # Extract contacts using LLM
+    contacts = extract_contacts_with_llm(cleaned_text)
+    
+    return cleaned_text, contacts
+
+async def extract_contacts_from_batches(batches: List[str], on_batch_done) -> List[List[Dict]]:
+    """Run the LLM over all batches concurrently, returning results in batch order"""
+    semaphore = asyncio.Semaphore(settings.LLM.LLAMA.MAX_CONCURRENT_REQUESTS)
+    results = [[] for _ in batches]
 
-def process_multiple_images(uploaded_files, batch_size: int = 5) -> List[Dict]:
-    """Process multiple images in batches"""
+    # Each run gets a fresh event loop, and pooled connections are tied to the
+    # loop that opened them, so the async client lives and dies with this run
+    limits = httpx.Limits(max_connections=settings.LLM.LLAMA.MAX_CONCURRENT_REQUESTS)
+    async with httpx.AsyncClient(limits=limits) as http_client:
+        llm = build_llm(http_async_client=http_client)
+
+        async def extract(batch_idx: int, text: str) -> tuple[int, List[Dict]]:
+            async with semaphore:
+                return batch_idx, await aextract_contacts_with_llm(text, llm)
+
+        tasks = [extract(batch_idx, text) for batch_idx, text in enumerate(batches)]
+        for completed, future in enumerate(asyncio.as_completed(tasks), 1):
+            batch_idx, batch_contacts = await future
+            results[batch_idx] = batch_contacts
+            on_batch_done(completed)
+    return results
+
+def process_multiple_images(uploaded_files, batch_size: Optional[int] = None) -> List[Dict]:
+    """Process multiple images in batches
+    
+    Batches are packed up to the configured prompt token budget; batch_size
+    optionally caps how many images share one LLM request.
+    """
     all_contacts = []
-    current_batch_text = []
-    current_batch_count = 0
     
     total_images = len(uploaded_files)
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    for idx, uploaded_file in enumerate(uploaded_files):
-        try:
-            status_text.text(f"Processing image {idx + 1}/{total_images}: {uploaded_file.name}")
-            
-            # Load image
-            image = Image.open(uploaded_file)
-            
-            # Preprocess image
-            image = preprocess_image(image)
+    # OCR images in parallel; both pytesseract (a tesseract subprocess) and
+    # tesserocr (C++ code) release the GIL, so worker threads keep every core busy
+    ocr_texts = [None] * total_images
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = {
+            executor.submit(ocr_image_bytes, uploaded_file.getvalue()): idx
+            for idx, uploaded_file in enumerate(uploaded_files)
+        }
+        for completed, future in enumerate(as_completed(futures), 1):
+            idx = futures[future]
+            uploaded_file = uploaded_files[idx]
+            status_text.text(f"Processed image {completed}/{total_images}: {uploaded_file.name}")
+            try:
+                ocr_texts[idx] = future.result()
+            except Exception as e:
+                st.error(f"Error processing {uploaded_file.name}: {str(e)}")
             
-            # Configure tesseract for better accuracy with screenshots
-            custom_config = r'--oem 3 --psm 6 -c preserve_interword_spaces=1'
-            text = pytesseract.image_to_string(image, config=custom_config)
-            
-            # Clean the text
-            cleaned_text = clean_text(text)
-            
-            # Add to current batch
-            current_batch_text.append(cleaned_text)
-            current_batch_count += 1
-            
-            # Process batch if we've reached batch_size or this is the last image
-            if current_batch_count == batch_size or idx == total_images - 1:
-                status_text.text(f"Processing batch with LLM...")
-                combined_text = "\n\n".join(current_batch_text)
-                batch_contacts = extract_contacts_with_llm(combined_text)
-                all_contacts.extend(batch_contacts)
-                
-                # Reset batch
-                current_batch_text = []
-                current_batch_count = 0
-            
-            # Update progress
-            progress_bar.progress((idx + 1) / total_images)
-            
-        except Exception as e:
-            st.error(f"Error processing {uploaded_file.name}: {str(e)}")
+            # Update progress (OCR fills the first half of the bar)
+            progress_bar.progress(completed / total_images * 0.5)
+    
+    # Pack the cleaned text into batches that fill the prompt token budget
+    cleaned_texts = [text for text in ocr_texts if text is not None]
+    batches = group_into_batches(cleaned_texts, settings.LLM.LLAMA.MAX_INPUT_TOKENS, batch_size)
+    
+    # Send all batches to the LLM concurrently
+    status_text.text(f"Processing {len(batches)} batches with LLM...")
+    
+    def on_batch_done(completed: int):
+        progress_bar.progress(0.5 + completed / len(batches) * 0.5)
+    
+    loop = asyncio.new_event_loop()
+    try:
+        batch_results = loop.run_until_complete(extract_contacts_from_batches(batches, on_batch_done))
+    finally:
+        loop.close()
+    
+    for batch_contacts in batch_results:
+        all_contacts.extend(batch_contacts)
     
+    progress_bar.progress(1.0)
     status_text.text("Processing complete!")
     return all_contacts
 
@@ -286,8 +406,8 @@ def main_app():
     # Sidebar for settings
     with st.sidebar:
         st.header("⚙️ Settings")
-        batch_size = st.slider("Batch Size", min_value=1, max_value=20, value=5, 
-                              help="Number of images to process together with LLM")
+        batch_size = st.slider("Max Images per Batch", min_value=0, max_value=50, value=0, 
+                              help="Maximum number of images to process together with LLM (0 = no limit; batches fill the prompt token budget)")
         
         st.header("👤 User Info")
         st.info(f"Logged in as: **{st.session_state.get('user_email', 'Unknown')}**")
@@ -323,7 +443,11 @@ def main_app():
                 st.subheader("🔄 Processing")
                 if st.button("Extract Contacts", key="single_extract"):
                     with st.spinner("Processing image..."):
-                        extracted_text, contacts = process_single_image(image)
+                        try:
+                            extracted_text, contacts = process_single_image_bytes(uploaded_file.getvalue())
+                        except Exception as e:
+                            st.error(f"Error processing image: {str(e)}")
+                            extracted_text, contacts = "", []
                     
                     if contacts:
                         st.success(f"Extracted {len(contacts)} contacts!")
@@ -366,16 +490,19 @@ def main_app():
             # Show preview of uploaded files
             with st.expander("👀 Preview Uploaded Files"):
                 cols = st.columns(min(len(uploaded_files), 4))
-                for idx, file in enumerate(uploaded_files[:4]):
+                preview_files = uploaded_files[:4]
+                # PIL releases the GIL while decoding, so previews decode in parallel
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    preview_images = list(executor.map(load_image, preview_files))
+                for idx, (file, image) in enumerate(zip(preview_files, preview_images)):
                     with cols[idx % 4]:
-                        image = Image.open(file)
                         st.image(image, caption=file.name, use_container_width=True)
                 if len(uploaded_files) > 4:
                     st.write(f"... and {len(uploaded_files) - 4} more files")
             
             if st.button("🚀 Extract All Contacts", key="multiple_extract"):
                 with st.spinner("Processing all images..."):
-                    all_contacts = process_multiple_images(uploaded_files, batch_size)
+                    all_contacts = process_multiple_images(uploaded_files, batch_size or None)
                 
                 if all_contacts:
                     st.success(f"🎉 Extracted {len(all_contacts)} total contacts from {len(uploaded_files)} images!")